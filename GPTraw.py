@@ -1,9 +1,18 @@
 import os
+import re
+import queue
+import threading
 from dotenv import load_dotenv
 import speech_recognition as sr
 import pyttsx3
 import google.generativeai as genai
 
+# Optional: Cloud Speech streaming recognition (pip install google-cloud-speech)
+try:
+    from google.cloud import speech
+except ImportError:
+    speech = None
+
 # ---------------------------------------
 # 1. Load from .env if not set in OS
 # ---------------------------------------
@@ -20,18 +29,33 @@ if not API_KEY:
 # ---------------------------------------
 # 2. Configure Gemini API
 # ---------------------------------------
-genai.configure(api_key=API_KEY)
+# Pin the gRPC transport (the SDK's default) explicitly; GEMINI_TRANSPORT=rest opts out
+genai.configure(api_key=API_KEY, transport=os.getenv("GEMINI_TRANSPORT", "grpc"))
 # Updated to use the current stable model
 model = genai.GenerativeModel("gemini-1.5-flash")
+# A single chat session for the whole conversation: each turn sends only the new message,
+# and earlier turns stay on the session as context.
+chat = model.start_chat()
 
 # ---------------------------------------
 # 3. Speech-to-Text
 # ---------------------------------------
+# One recognizer for the whole session. The noise floor is calibrated on the first turn only;
+# after that dynamic_energy_threshold tracks drift without blocking before each listen.
+recognizer = sr.Recognizer()
+recognizer.dynamic_energy_threshold = True
+_CALIBRATED = False
+
+def calibrate_once(source):
+    global _CALIBRATED
+    if not _CALIBRATED:
+        recognizer.adjust_for_ambient_noise(source, duration=0.5)
+        _CALIBRATED = True
+
 def listen_to_audio():
-    recognizer = sr.Recognizer()
     with sr.Microphone() as source:
         print("🎤 Listening...")
-        recognizer.adjust_for_ambient_noise(source)
+        calibrate_once(source)
         audio = recognizer.listen(source)
 
     try:
@@ -45,41 +69,196 @@ def listen_to_audio():
         print(f"⚠ Could not request results; {e}")
         return ""
 
+# Streaming variant: audio is uploaded while the user is still talking and the transcript is
+# returned as soon as Cloud Speech marks it final, instead of record-everything-then-upload.
+# Used when google-cloud-speech is installed and service-account credentials are configured.
+STREAMING_SAMPLE_RATE = 16000
+USE_STREAMING_STT = speech is not None and bool(os.getenv("GOOGLE_APPLICATION_CREDENTIALS"))
+_MIC_LOCK = threading.Lock()
+_speech_client = None
+
+def _record_chunks(chunks):
+    """
+    Push raw LINEAR16 chunks of one utterance into `chunks`, then None.
+    If the mic fails (including failing to open), the exception is queued before the None.
+    """
+    try:
+        with _MIC_LOCK, sr.Microphone(sample_rate=STREAMING_SAMPLE_RATE) as source:
+            print("🎤 Listening...")
+            calibrate_once(source)
+            for audio in recognizer.listen(source, stream=True):
+                chunks.put(audio.get_raw_data())
+    except Exception as e:
+        chunks.put(e)
+    finally:
+        chunks.put(None)
+
+def _audio_requests(chunks, mic_errors):
+    """Turn queued chunks into streaming requests; stops at the end of the utterance or a mic error."""
+    while isinstance(item := chunks.get(), bytes):
+        yield speech.StreamingRecognizeRequest(audio_content=item)
+    if item is not None:
+        mic_errors.append(item)
+
+def listen_streaming():
+    global _speech_client
+    if _speech_client is None:
+        _speech_client = speech.SpeechClient()
+    config = speech.StreamingRecognitionConfig(
+        config=speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=STREAMING_SAMPLE_RATE,
+            language_code="en-US",
+        ),
+        interim_results=True,
+        single_utterance=True,
+    )
+
+    chunks = queue.Queue()
+    threading.Thread(target=_record_chunks, args=(chunks,), daemon=True).start()
+    mic_errors = []
+    requests = _audio_requests(chunks, mic_errors)
+    try:
+        for response in _speech_client.streaming_recognize(config, requests):
+            for result in response.results:
+                if not result.alternatives:
+                    continue
+                text = result.alternatives[0].transcript
+                if result.is_final:
+                    # The recorder thread keeps the mic (and _MIC_LOCK) until it hears silence
+                    print(f"🗣 You said: {text}")
+                    return text.strip()
+                print(f"🗣 … {text}", end="\r", flush=True)
+    except Exception as e:
+        if not mic_errors:
+            print(f"⚠ Could not request results; {e}")
+            return ""
+    if mic_errors:
+        # No usable microphone: let the listener stop the pipeline instead of retrying forever
+        raise mic_errors[0]
+    print("⚠ Sorry, I could not understand the audio.")
+    return ""
+
+listen = listen_streaming if USE_STREAMING_STT else listen_to_audio
+
 # ---------------------------------------
 # 4. Get AI Response
 # ---------------------------------------
-def genai_response(prompt):
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+def genai_sentences(prompt):
+    """Stream the reply from Gemini and yield it one complete sentence at a time."""
+    buffer = ""
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        for chunk in chat.send_message(prompt, stream=True):
+            try:
+                buffer += chunk.text
+            except ValueError:
+                # Chunks carrying only finish_reason / safety metadata have no text
+                continue
+            *sentences, buffer = _SENTENCE_BREAK.split(buffer)
+            for sentence in sentences:
+                if sentence.strip():
+                    yield sentence
+        # Raises BrokenResponseError if the stream ended with a non-STOP finish_reason (e.g. SAFETY)
+        chat.history
     except Exception as e:
         print(f"⚠ Error generating AI response: {e}")
-        return "Sorry, I encountered an error processing your request."
+        buffer += " Sorry, I encountered an error processing your request."
+        # A broken turn would make every later send_message raise: drop it from the session
+        try:
+            chat.history
+        except genai.types.BrokenResponseError:
+            chat.rewind()
+    if buffer.strip():
+        yield buffer.strip()
 
 # ---------------------------------------
 # 5. Speak Text
 # ---------------------------------------
+# Driver start-up (SAPI5 / NSSpeechSynthesizer / espeak) is slow, so create the engine once.
+# pyttsx3 is not thread-safe: every use goes through _TTS_LOCK.
+_TTS_LOCK = threading.Lock()
+_TTS_ENGINE = pyttsx3.init()
+
 def speak_text(text):
-    try:
-        engine = pyttsx3.init()
-        engine.say(text)
-        engine.runAndWait()
-    except Exception as e:
-        print(f"⚠ Error with text-to-speech: {e}")
+    global _TTS_ENGINE
+    with _TTS_LOCK:
+        try:
+            _TTS_ENGINE.say(text)
+            _TTS_ENGINE.runAndWait()
+        except RuntimeError:
+            # Some drivers can't restart their run loop after an error; build a fresh engine and retry once.
+            # pyttsx3.init() would hand back the same cached (broken) engine, so construct one directly.
+            try:
+                _TTS_ENGINE = pyttsx3.Engine()
+                _TTS_ENGINE.say(text)
+                _TTS_ENGINE.runAndWait()
+            except Exception as e:
+                print(f"⚠ Error with text-to-speech: {e}")
+        except Exception as e:
+            print(f"⚠ Error with text-to-speech: {e}")
 
 # ---------------------------------------
 # 6. Main Loop
 # ---------------------------------------
+# The three stages run concurrently and hand work over through queues:
+#   listener (thread) -> prompt_q -> responder (thread) -> speak_q -> speaker (main thread)
+# The responder streams Gemini's reply, so the first sentence is spoken while the rest is still
+# being generated. The listener waits for `turn_done` before opening the mic again, otherwise
+# it would transcribe the assistant's own voice.
+_STOP = object()
+_END_OF_TURN = object()
+
+# Each worker always passes _STOP downstream when it ends, even on an unexpected error
+# (e.g. no input device), so the speaker on the main thread exits instead of waiting forever.
+def listener(prompt_q, turn_done):
+    try:
+        while True:
+            turn_done.wait()
+            user_input = listen()
+            if user_input.lower() in ["exit", "quit", "stop"]:
+                print("👋 Exiting...")
+                return
+            if user_input.strip():
+                turn_done.clear()
+                prompt_q.put(user_input)
+    except Exception as e:
+        print(f"⚠ Listener stopped: {e!r}")
+    finally:
+        prompt_q.put(_STOP)
+
+def responder(prompt_q, speak_q):
+    try:
+        while (prompt := prompt_q.get()) is not _STOP:
+            print("🤖 AI:", end=" ", flush=True)
+            for sentence in genai_sentences(prompt):
+                print(sentence, end=" ", flush=True)
+                speak_q.put(sentence)
+            print()
+            speak_q.put(_END_OF_TURN)
+    except Exception as e:
+        print(f"⚠ Responder stopped: {e!r}")
+    finally:
+        speak_q.put(_STOP)
+
+def speaker(speak_q, turn_done):
+    # Runs on the main thread: the TTS engine was created there and some drivers (SAPI5 via COM) are thread-bound
+    while (item := speak_q.get()) is not _STOP:
+        if item is _END_OF_TURN:
+            turn_done.set()
+        else:
+            speak_text(item)
+
 if __name__ == "__main__":
     print("🤖 Voice AI Assistant Started!")
     print("Say 'exit', 'quit', or 'stop' to end the conversation.")
-    
-    while True:
-        user_input = listen_to_audio()
-        if user_input.lower() in ["exit", "quit", "stop"]:
-            print("👋 Exiting...")
-            break
-        if user_input.strip():
-            ai_output = genai_response(user_input)
-            print(f"🤖 AI: {ai_output}")
-            speak_text(ai_output)
\ No newline at end of file
+
+    prompt_q = queue.Queue()
+    speak_q = queue.Queue()
+    turn_done = threading.Event()
+    turn_done.set()
+
+    threading.Thread(target=listener, args=(prompt_q, turn_done), daemon=True).start()
+    threading.Thread(target=responder, args=(prompt_q, speak_q), daemon=True).start()
+    speaker(speak_q, turn_done)
\ No newline at end of file
@@ -6,12 +6,25 @@ Single-file Flask app that serves:
 Features:
  - Safe fallbacks: if GOOGLE_API_KEY is missing or USE_MOCK=1, the server uses a mock reply (for local testing).
  - Robust response extraction from the SDK object.
+ - Replies are streamed to the browser as Server-Sent Events so speech can start on the first sentence.
 """
 
 import os
+import gzip
 import json
+import re
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+import brotli
+import orjson
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, render_template_string, stream_with_context
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 
 # Load .env if present
 load_dotenv()
@@ -20,6 +33,18 @@ load_dotenv()
 API_KEY = os.getenv("GOOGLE_API_KEY")
 USE_MOCK = os.getenv("USE_MOCK", "0").lower() in ("1", "true", "yes")
 DEBUG = os.getenv("DEBUG", "1").lower() in ("1", "true", "yes")
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "1024"))
+# Idle seconds before a browser's chat session (and its history) is dropped
+CHAT_SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", "900"))
+# Threads per process when served through ASGI (each in-flight chat holds one while waiting on Gemini)
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", "64"))
+# Server processes when run via `python new.py`. Chat sessions and the reply cache live in process
+# memory, so more than one worker only makes sense behind a sticky load balancer.
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+# Concurrent Gemini calls per process, and how often an idle reply stream sends an SSE keepalive
+GEMINI_THREADS = int(os.getenv("GEMINI_THREADS", "64"))
+KEEPALIVE_INTERVAL = 0.25
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "grpc")
 
 # Try to import Google generative SDK; allow app to run in mock mode if import fails.
 genai = None
@@ -28,7 +53,9 @@ if not USE_MOCK:
     try:
         import google.generativeai as genai
         if API_KEY:
-            genai.configure(api_key=API_KEY)
+            # Pin the gRPC transport (the SDK's default) explicitly so it can't silently change;
+            # GEMINI_TRANSPORT=rest opts out.
+            genai.configure(api_key=API_KEY, transport=GEMINI_TRANSPORT)
             # Choose the model name you have access to; keep gemini-pro if you have access
             try:
                 model = genai.GenerativeModel("gemini-2.5-flash")
@@ -46,7 +73,29 @@ if not USE_MOCK:
         print("Warning: google.generativeai import failed or initialization failed:", str(e))
         USE_MOCK = True
 
+
+class OrjsonProvider(JSONProvider):
+    """
+    Route jsonify() and request JSON parsing through orjson instead of the stdlib json.
+    Output is always compact: unlike Flask's default provider it never indents, even with debug=True.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json_provider_class = OrjsonProvider
+app.json = OrjsonProvider(app)
+
+# Brotli/gzip for the page and JSON replies, chosen from the client's Accept-Encoding.
+# text/event-stream isn't in COMPRESS_MIMETYPES, so streamed replies are never buffered for compression.
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 256
+Compress(app)
 
 
 # Simple HTML/JS served from here (so it's a single-file app). You can replace with templates if preferred.
@@ -113,9 +162,60 @@ INDEX_HTML = """
     wrapper.appendChild(b);
     chatEl.appendChild(wrapper);
     chatEl.scrollTop = chatEl.scrollHeight;
+    return b;
+  }
+
+  function speak(text){
+    if(!('speechSynthesis' in window) || !text.trim()) return;
+    window.speechSynthesis.speak(new SpeechSynthesisUtterance(text.trim()));
+  }
+
+  // Speak every complete sentence in `text` and return the unfinished tail.
+  function speakCompleteSentences(text){
+    const m = text.match(/^[\\s\\S]*[.!?](?=\\s)/);
+    if(!m) return text;
+    m[0].split(/(?<=[.!?])\\s+/).forEach(speak);
+    return text.slice(m[0].length);
+  }
+
+  // Read a text/event-stream reply, growing the bubble and queueing speech sentence by sentence.
+  async function readStream(res){
+    const bubble = append('assistant', '');
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buf = '', reply = '', pending = '';
+    if('speechSynthesis' in window) window.speechSynthesis.cancel();
+
+    while(true){
+      const {value, done} = await reader.read();
+      if(done) break;
+      buf += decoder.decode(value, {stream: true});
+      let idx;
+      while((idx = buf.indexOf('\\n\\n')) !== -1){
+        const evt = buf.slice(0, idx);
+        buf = buf.slice(idx + 2);
+        for(const line of evt.split('\\n')){
+          // Lines starting with ':' are SSE comments (keepalives); only 'data:' carries payload.
+          if(!line.startsWith('data:')) continue;
+          const payload = JSON.parse(line.slice(5));
+          if(payload.error){
+            reply += (reply ? '\\n' : '') + 'Error: ' + payload.error;
+          } else if(payload.delta){
+            reply += payload.delta;
+            pending = speakCompleteSentences(pending + payload.delta);
+          }
+          bubble.innerText = reply;
+          chatEl.scrollTop = chatEl.scrollHeight;
+        }
+      }
+    }
+    speak(pending);
+    if(!reply) bubble.innerText = '(no reply)';
   }
 
   async function sendMessage(text){
+    // Enter bypasses the disabled Send button: only one message in flight at a time
+    if(sendBtn.disabled) return;
     if(!text || !text.trim()) return;
     append('user', text);
     inputEl.value = '';
@@ -128,6 +228,11 @@ INDEX_HTML = """
         headers: {'Content-Type': 'application/json'},
         body: JSON.stringify({message: text})
       });
+      const ctype = res.headers.get('Content-Type') || '';
+      if(res.ok && ctype.startsWith('text/event-stream')){
+        await readStream(res);
+        return;
+      }
       const data = await res.json();
       if(!res.ok){
         append('assistant', 'Error: ' + (data.error || 'Server error'));
@@ -136,9 +241,8 @@ INDEX_HTML = """
         append('assistant', reply);
         // Speak reply
         if('speechSynthesis' in window){
-          const utt = new SpeechSynthesisUtterance(reply);
           window.speechSynthesis.cancel();
-          window.speechSynthesis.speak(utt);
+          speak(reply);
         }
       }
     } catch(err){
@@ -219,103 +323,339 @@ INDEX_HTML = """
 </html>
 """
 
-def extract_text_from_response(resp):
+def _extract_text_attr(resp):
+    return resp.text
+
+# Accessors for the response shapes seen across google.generativeai versions (and their mapping
+# forms), most common first. Each returns the text or raises one of _SHAPE_ERRORS.
+_RESPONSE_SHAPES = (
+    _extract_text_attr,
+    lambda r: r.candidates[0].output_text,
+    lambda r: r.candidates[0].content.parts[0].text,
+    lambda r: r.candidates[0].content[0].text,
+    lambda r: r.candidates[0].content[0]["text"],
+    lambda r: r.candidates[0].content[0],
+    lambda r: r["candidates"][0]["output_text"],
+    lambda r: r["candidates"][0]["content"][0]["text"],
+    lambda r: r["candidates"][0]["content"][0],
+)
+# ValueError: the SDK's .text raises it for chunks without text parts
+_SHAPE_ERRORS = (AttributeError, LookupError, TypeError, ValueError)
+
+# type(resp) -> the shape that last matched for that type
+_EXTRACTORS = {}
+
+def _probe_shapes(resp):
+    """Return (shape, text) for the first shape that yields non-empty text, else (None, None)."""
+    for shape in _RESPONSE_SHAPES:
+        try:
+            text = shape(resp)
+        except _SHAPE_ERRORS:
+            continue
+        if isinstance(text, str) and text:
+            return shape, text
+    return None, None
+
+def extract_text(resp):
     """
-    Try common attributes / shapes returned by google.generativeai SDK objects.
-    Return a text string for the reply; never raise here.
+    Return the reply text carried by an SDK response (or stream chunk), or None if it has none,
+    e.g. a chunk with only finish_reason / safety data. Never stringifies the object itself.
+    Shapes are probed once per response type; later responses of that type use the accessor that matched.
     """
-    try:
-        if resp is None:
-            return None
-        # If it's already a string
-        if isinstance(resp, str):
-            return resp
-        # If object has .text property (common)
-        text = getattr(resp, "text", None)
-        if text:
-            return text
-        # Try candidates -> content -> text
-        candidates = getattr(resp, "candidates", None)
-        if candidates:
-            try:
-                first = candidates[0]
-                # Some SDK versions have first.output_text
-                if hasattr(first, "output_text"):
-                    return first.output_text
-                # Some nested structures: first.content is list with dicts containing text
-                content = getattr(first, "content", None)
-                if content:
-                    # if content is a list of dicts or strings
-                    if isinstance(content, (list, tuple)) and len(content) > 0:
-                        c0 = content[0]
-                        # object with .text
-                        if hasattr(c0, "text"):
-                            return c0.text
-                        # dict with 'text'
-                        if isinstance(c0, dict) and "text" in c0:
-                            return c0["text"]
-                        # string
-                        if isinstance(c0, str):
-                            return c0
-            except Exception:
-                pass
-        # Try mapping-like shapes
-        if isinstance(resp, dict):
-            # candidates -> first -> output_text or content
-            if "candidates" in resp and resp["candidates"]:
-                cand = resp["candidates"][0]
-                if isinstance(cand, dict):
-                    if "output_text" in cand:
-                        return cand["output_text"]
-                    if "content" in cand and isinstance(cand["content"], list) and cand["content"]:
-                        c0 = cand["content"][0]
-                        if isinstance(c0, dict) and "text" in c0:
-                            return c0["text"]
-                        if isinstance(c0, str):
-                            return c0
-        # last resort: string representation
-        return str(resp)
-    except Exception:
+    if resp is None or isinstance(resp, str):
+        return resp
+    resp_type = type(resp)
+    shape = _EXTRACTORS.get(resp_type)
+    if shape is not None:
         try:
-            return str(resp)
-        except Exception:
-            return "(unable to extract text)"
+            text = shape(resp)
+        except _SHAPE_ERRORS:
+            text = None
+        if isinstance(text, str) and text:
+            return text
+    shape, text = _probe_shapes(resp)
+    # Only cache a shape that matched; mappings differ per value, so they are never cached
+    if shape is not None and resp_type is not dict:
+        _EXTRACTORS[resp_type] = shape
+    return text
+
+def select_extractor():
+    """
+    Pick the reply extractor once, from the installed SDK's response type.
+    Current google.generativeai responses (and their stream chunks) expose a `.text` property,
+    so the hot path is a single attribute read; other SDK shapes go through extract_text.
+    """
+    types = getattr(genai, "types", None)
+    response_type = getattr(types, "GenerateContentResponse", None)
+    if isinstance(getattr(response_type, "text", None), property):
+        return _extract_text_attr
+    return extract_text
+
+_EXTRACT = select_extractor()
+
+def minify_html(html):
+    """
+    Conservative minifier for INDEX_HTML: drops HTML comments, indentation, blank lines and
+    whole-line // comments. Line breaks are kept so the inline JS never depends on them being there.
+    """
+    html = re.sub(r"<!--.*?-->", "", html, flags=re.S)
+    lines = (line.strip() for line in html.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+# The page only depends on USE_MOCK, which is fixed for the life of the process: render, minify
+# and compress it once, then serve the variant matching the client's Accept-Encoding.
+with app.app_context():
+    _INDEX_RENDERED = render_template_string(INDEX_HTML, use_mock=str(USE_MOCK).lower())
+_INDEX_MIN = minify_html(_INDEX_RENDERED).encode()
+_INDEX_BR = brotli.compress(_INDEX_MIN, quality=11)
+_INDEX_GZIP = gzip.compress(_INDEX_MIN, compresslevel=9)
 
 @app.route("/")
 def index():
-    return render_template_string(INDEX_HTML, use_mock=str(USE_MOCK).lower())
+    # Setting Content-Encoding ourselves also tells flask-compress to leave the body alone
+    encodings = request.accept_encodings
+    if encodings["br"]:
+        body, encoding = _INDEX_BR, "br"
+    elif encodings["gzip"]:
+        body, encoding = _INDEX_GZIP, "gzip"
+    else:
+        return Response(_INDEX_MIN, mimetype="text/html")
+    return Response(body, mimetype="text/html", headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+
+def sse_event(payload):
+    """Format a dict as a single Server-Sent Events `data:` frame."""
+    return f"data: {app.json.dumps(payload)}\n\n"
+
+# Exact-match LRU of finished replies, keyed by the normalized prompt.
+# Guarded by a lock because the server handles requests on several threads.
+_reply_cache = OrderedDict()
+_reply_cache_lock = threading.Lock()
+
+def normalize_prompt(text):
+    """Lower-case and collapse whitespace so trivially different prompts share a cache entry."""
+    return " ".join(str(text).lower().split())
+
+def get_cached_reply(key):
+    with _reply_cache_lock:
+        reply = _reply_cache.get(key)
+        if reply is not None:
+            _reply_cache.move_to_end(key)
+        return reply
+
+def store_cached_reply(key, reply):
+    if REPLY_CACHE_SIZE <= 0:
+        return
+    with _reply_cache_lock:
+        _reply_cache[key] = reply
+        _reply_cache.move_to_end(key)
+        while len(_reply_cache) > REPLY_CACHE_SIZE:
+            _reply_cache.popitem(last=False)
+
+# One ChatSession per browser (keyed by the chat_id cookie), so each request only sends the new
+# turn and the provider can reuse the conversation prefix. TTLCache isn't thread-safe: use the lock.
+SESSION_COOKIE = "chat_id"
+_chat_sessions = TTLCache(maxsize=10000, ttl=CHAT_SESSION_TTL)
+_chat_sessions_lock = threading.Lock()
+
+def get_chat_session(session_id):
+    """Return (chat, turn_lock) for this browser; turn_lock is held while a reply is in flight."""
+    with _chat_sessions_lock:
+        session = _chat_sessions.get(session_id)
+        if session is None:
+            session = (model.start_chat(), threading.Lock())
+        # Re-inserting refreshes the TTL, so only idle sessions expire
+        _chat_sessions[session_id] = session
+        return session
+
+def recover_chat_session(session_id, session):
+    """
+    Call after a failed turn. A streamed reply that errored or was blocked (e.g. SAFETY) leaves the
+    ChatSession raising BrokenResponseError on every later use, so rewind that turn. Errors raised
+    before any reply (network, 429/503, blocked prompt) leave the history intact: keep it as is.
+    The session is only dropped if it can't be repaired.
+    """
+    chat = session[0]
+    try:
+        chat.history
+    except genai.types.BrokenResponseError:
+        try:
+            chat.rewind()
+            chat.history
+        except Exception:
+            with _chat_sessions_lock:
+                if _chat_sessions.get(session_id) is session:
+                    del _chat_sessions[session_id]
+
+# Gemini calls run on this pool so the response generator can send keepalives while it waits
+_gemini_pool = ThreadPoolExecutor(max_workers=GEMINI_THREADS, thread_name_prefix="gemini")
+_STREAM_DONE = object()
+
+def pump_reply_chunks(session_id, session, user_message, out):
+    """
+    Push the reply's text pieces into `out` as they arrive, then _STREAM_DONE; an error is pushed as the exception.
+    Releases the session's turn lock when the reply is finished, even if the client has gone away.
+    """
+    chat, turn_lock = session
+    try:
+        for chunk in chat.send_message(user_message, stream=True):
+            try:
+                text = _EXTRACT(chunk)
+            except ValueError:
+                # Chunks carrying only finish_reason / safety metadata have no text parts
+                continue
+            except AttributeError:
+                text = extract_text(chunk)
+            if text:
+                out.put(text)
+        # Raises BrokenResponseError if the stream ended with a non-STOP finish_reason
+        chat.history
+    except Exception as e:
+        recover_chat_session(session_id, session)
+        out.put(e)
+    finally:
+        turn_lock.release()
+        out.put(_STREAM_DONE)
+
+def stream_reply(session_id, session, user_message):
+    """
+    Yield the Gemini reply as SSE frames of the form {"delta": "..."}.
+    Errors after the stream has started can't change the status code, so they are sent as {"error": "..."}.
+    The reply cache only applies to the first turn of a session: later answers depend on the history.
+    """
+    chat, turn_lock = session
+    # Two tabs share the cookie: a second turn while one is in flight would corrupt the history
+    if not turn_lock.acquire(blocking=False):
+        yield sse_event({"error": "Still answering the previous message."})
+        return
+
+    try:
+        key = normalize_prompt(user_message)
+        first_turn = not chat.history
+        cached = get_cached_reply(key) if first_turn else None
+        if cached is not None:
+            # Record the turn so follow-up questions still have context
+            chat.history = [
+                {"role": "user", "parts": [user_message]},
+                {"role": "model", "parts": [cached]},
+            ]
+    except Exception as e:
+        recover_chat_session(session_id, session)
+        turn_lock.release()
+        msg = str(e) if DEBUG else "Model error"
+        yield sse_event({"error": msg})
+        return
+    if cached is not None:
+        turn_lock.release()
+        yield sse_event({"delta": cached})
+        return
+
+    out = queue.Queue()
+    # From here on pump_reply_chunks owns the turn lock
+    _gemini_pool.submit(pump_reply_chunks, session_id, session, user_message, out)
+    parts = []
+    while True:
+        try:
+            item = out.get(timeout=KEEPALIVE_INTERVAL)
+        except queue.Empty:
+            # SSE comment line: shows the client the request is alive and stops proxies buffering
+            yield ":\n\n"
+            continue
+        if item is _STREAM_DONE:
+            break
+        if isinstance(item, Exception):
+            # In debug show error message; in production hide details
+            msg = str(item) if DEBUG else "Model error"
+            yield sse_event({"error": msg})
+            return
+        parts.append(item)
+        yield sse_event({"delta": item})
+
+    # Only complete, successful replies are cached
+    if parts and first_turn:
+        store_cached_reply(key, "".join(parts))
+
+# Constant error bodies, serialized once. A fresh Response is still built per request: Response
+# objects are mutable (after_request hooks, compression) and must not be shared between requests.
+_ERR_MISSING = orjson.dumps({"error": "Missing 'message' field."})
+_ERR_EMPTY = orjson.dumps({"error": "Empty message."})
+_ERR_NO_MODEL = orjson.dumps({"error": "Model not initialized. Check server logs and API key."})
+
+_MOCK_TPL = b'{"reply":"(mock) I received: %s"}'
+
+def escape_json(text):
+    """JSON-escape `text` for splicing into a string literal (orjson's quoted output minus the quotes)."""
+    return orjson.dumps(text)[1:-1]
+
+def json_error(body, status):
+    return Response(body, status=status, mimetype="application/json")
 
 @app.route("/api/chat", methods=["POST"])
 def api_chat():
-    data = request.get_json(silent=True)
-    if not data or "message" not in data:
-        return jsonify({"error": "Missing 'message' field."}), 400
+    # Parse the body straight from bytes with orjson, skipping Flask's content-type checks
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or "message" not in data:
+        return json_error(_ERR_MISSING, 400)
     user_message = data["message"]
 
     if not user_message or not str(user_message).strip():
-        return jsonify({"error": "Empty message."}), 400
+        return json_error(_ERR_EMPTY, 400)
 
     # Mock mode for local testing
     if USE_MOCK:
-        reply = f"(mock) I received: {user_message}"
-        return jsonify({"reply": reply})
+        return Response(_MOCK_TPL % escape_json(str(user_message)), mimetype="application/json")
 
     # Real call to Google Generative AI
-    try:
-        if model is None:
-            return jsonify({"error": "Model not initialized. Check server logs and API key."}), 500
+    if model is None:
+        return json_error(_ERR_NO_MODEL, 500)
+
+    session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+    session = get_chat_session(session_id)
+    response = Response(
+        stream_with_context(stream_reply(session_id, session, user_message)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.set_cookie(SESSION_COOKIE, session_id, max_age=CHAT_SESSION_TTL, httponly=True, samesite="Lax")
+    return response
 
-        # model.generate_content may accept a string or more complex input depending on SDK version
-        resp = model.generate_content(user_message)
-        reply_text = extract_text_from_response(resp)
-        return jsonify({"reply": reply_text})
-    except Exception as e:
-        # In debug show error message; in production hide details
-        msg = str(e) if DEBUG else "Model error"
-        return jsonify({"error": msg}), 500
+
+# ASGI entry point: `uvicorn new:asgi_app --workers N`.
+# api_chat stays a sync generator because Flask can't stream from an async one, so concurrency
+# comes from a2wsgi's thread pool: each request waits on Gemini in its own thread, off the event loop.
+try:
+    from a2wsgi import WSGIMiddleware
+    asgi_app = WSGIMiddleware(app, workers=ASGI_THREADS)
+except ImportError:
+    asgi_app = None
 
 
 if __name__ == "__main__":
     # Important: ensure this file is NOT named flask.py to avoid shadowing the real flask package.
     print(f"Starting Flask app (USE_MOCK={USE_MOCK}). DEBUG={DEBUG}")
-    app.run(host="0.0.0.0", port=5000, debug=DEBUG)
+    if asgi_app is not None:
+        # Prefer uvicorn over the Werkzeug dev server; requests run on the a2wsgi thread pool
+        try:
+            import uvicorn
+        except ImportError:
+            uvicorn = None
+        if uvicorn is not None:
+            # One worker serves this process's asgi_app directly. Extra worker processes need an import
+            # string, which re-imports the module (and repeats its start-up work) in each of them.
+            if WEB_WORKERS > 1:
+                module_name = os.path.splitext(os.path.basename(__file__))[0]
+                target = f"{module_name}:asgi_app"
+            else:
+                target = asgi_app
+            uvicorn.run(
+                target,
+                host="0.0.0.0",
+                port=5000,
+                workers=WEB_WORKERS,
+                log_level="debug" if DEBUG else "info",
+            )
+            raise SystemExit(0)
+    print("uvicorn/a2wsgi not installed; falling back to the Flask development server.")
+    app.run(host="0.0.0.0", port=5000, debug=DEBUG, threaded=True)